@@ -21,10 +21,18 @@
 
 
 from __future__ import print_function
-from time import sleep
+from bisect import bisect_left
+from collections import deque
+from difflib import get_close_matches
+from itertools import islice, takewhile
+from time import sleep, time
 from platform import uname
+from urllib.parse import urlencode
+import tempfile
 import yaml
+import stat
 import sys
+import os
 import re
 
 import boto3
@@ -38,6 +46,33 @@ from universal_extension import ExtensionResult
 from universal_extension.deco import dynamic_choice_command, dynamic_command
 from universal_extension import ui
 
+# Console log lines marking the start and the end of a JCL step. Both the
+# "STEP STARTED STEP01" and the "STEP STEP01 STARTED" layouts are accepted.
+# The end line carries either a return code or an abend code (S0C7, U4038).
+JCL_STEP_RC_PATTERN = (
+    r"(?:.*?\b(?:COND CODE|RETURN CODE|RC|ABEND(?:ED)?(?: CODE)?)\b"
+    r"\s*[=:]?\s*(?P<rc>\d+|[SU][0-9A-F]{3,4})\b)?"
+)
+JCL_STEP_START_PATTERNS = (
+    re.compile(r"\bSTEP\s+STARTED\s+(?P<step>[\w#@$.]+)", re.IGNORECASE),
+    re.compile(r"\bSTEP\s+(?P<step>[\w#@$.]+)\s+STARTED\b", re.IGNORECASE),
+)
+JCL_STEP_END_PATTERNS = (
+    re.compile(
+        r"\bSTEP\s+ENDED\s+(?P<step>[\w#@$.]+)" + JCL_STEP_RC_PATTERN,
+        re.IGNORECASE,
+    ),
+    re.compile(
+        r"\bSTEP\s+(?P<step>[\w#@$.]+)\s+ENDED\b" + JCL_STEP_RC_PATTERN,
+        re.IGNORECASE,
+    ),
+)
+
+# Log pages read when no filter pattern narrows the ConsoleLog group, and
+# the upper bound when one does.
+LOG_EVENTS_UNFILTERED_PAGES = 1
+LOG_EVENTS_MAX_PAGES = 50
+
 
 class Extension(UniversalExtension):
     """Required class that serves as the entry point for the extension"""
@@ -141,6 +176,33 @@ class Extension(UniversalExtension):
                 values=["failed"],
             )
 
+    @dynamic_choice_command("jcl_name")
+    def get_jcl_names(self, fields):
+        """Get List of JCL names starting with the given prefix"""
+        self.setup_aws(fields)
+        self.fields = self.get_fields(fields)
+        application_id = self.parse_application_id(
+            self.fields.application or ""
+        )
+        prefix = self.fields.jcl_prefix or ""
+        index = self.get_batch_job_index(
+            application_id, ttl=self.fields.jcl_cache_ttl
+        )
+        if index is None:
+            return ExtensionResult(
+                rc=1,
+                message="Failed to get the batch job definitions.",
+                values=["failed"],
+            )
+
+        names, total = index.search(prefix)
+        message = "JCL names starting with '{}': '{}'".format(prefix, names)
+        if total > len(names):
+            message = "Showing {} of {} JCL names starting with '{}', refine JCL Name Prefix: '{}'".format(
+                len(names), total, prefix, names
+            )
+        return ExtensionResult(rc=0, message=message, values=names)
+
     @dynamic_command("rerun")
     def rerun(self, fields):
         """Dynamic command implementation for rerun command.
@@ -284,23 +346,19 @@ class Extension(UniversalExtension):
 
     def list_batch_jobs(self, application_id):
         self.log.debug(f"application_id = {application_id}")
-        url = self.get_aws_url(
-            f"/applications/{application_id}/batch-job-definitions"
+        self.batch_job_error_response = None
+        # The listing also refreshes the cached JCL name index.
+        index = BatchJobIndex(
+            self.base_url,
+            self.region,
+            application_id,
+            self.fields.jcl_cache_ttl,
         )
-        response = self.signed_request(
-            method="GET", url=url, headers=self.headers
-        )
-        if response.status_code == 200:
-            for app in response.json()["batchJobDefinitions"]:
-                file_definition = app.get("fileBatchJobDefinition", None)
-                if file_definition is not None:
-                    print(
-                        f'FILE: {file_definition["folderPath"]}/{file_definition["fileName"]}'
-                    )
-                script_definition = app.get("scriptBatchJobDefinition", None)
-                if script_definition is not None:
-                    print(f'SCRIPT: {script_definition["scriptName"]}')
-        else:
+        definitions = self.iter_batch_job_definitions(application_id)
+        index.build(self.print_batch_job_definitions(definitions))
+
+        response = self.batch_job_error_response
+        if response is not None:
             self.log.error(
                 f"Error while listing batch jobs. Response body = {response.text}, status_code = {response.status_code}"
             )
@@ -308,9 +366,120 @@ class Extension(UniversalExtension):
             self.unv_output = f"FAILED: Response body = {response.text}, status_code = {response.status_code}"
             return False
 
-        self.log.info(f"Response = {response.text}")
+        index.save()
         return True
 
+    def print_batch_job_definitions(self, definitions):
+        """Print the definitions and yield their JCL names."""
+        for app in definitions:
+            file_definition = app.get("fileBatchJobDefinition", None)
+            if file_definition is not None:
+                print(
+                    f'FILE: {file_definition["folderPath"]}/{file_definition["fileName"]}'
+                )
+            script_definition = app.get("scriptBatchJobDefinition", None)
+            if script_definition is not None:
+                print(f'SCRIPT: {script_definition["scriptName"]}')
+            yield batch_job_name(app)
+
+    def iter_batch_job_definitions(self, application_id):
+        """Yield the batch job definitions page by page, following nextToken.
+
+        A failed request stops the iteration and is kept in
+        ``self.batch_job_error_response`` for the caller to report.
+        """
+        params = {}
+        while True:
+            url = self.get_aws_url(
+                f"/applications/{application_id}/batch-job-definitions"
+            )
+            if len(params) > 0:
+                url = f"{url}?{urlencode(params)}"
+            response = self.signed_request(
+                method="GET", url=url, headers=self.headers
+            )
+            if response.status_code != 200:
+                self.batch_job_error_response = response
+                return
+
+            self.log.debug(f"Response = {response.text}")
+            response_json = response.json()
+            for definition in response_json.get("batchJobDefinitions", []):
+                yield definition
+
+            next_token = response_json.get("nextToken")
+            if not next_token or next_token == params.get("nextToken"):
+                return
+            params["nextToken"] = next_token
+
+    def get_batch_job_index(self, application_id, ttl, refresh=False):
+        """Return the JCL name index of the application.
+
+        The index is read from the local cache while it is younger than
+        ``ttl`` seconds, otherwise it is rebuilt from the batch job
+        definitions. Returns None if the definitions can not be listed.
+        """
+        if application_id is None:
+            return None
+
+        index = BatchJobIndex(self.base_url, self.region, application_id, ttl)
+        if not refresh and index.load():
+            self.log.debug(f"Batch job index loaded from {index.path}")
+            return index
+
+        self.batch_job_error_response = None
+        definitions = self.iter_batch_job_definitions(application_id)
+        try:
+            index.build(
+                batch_job_name(definition) for definition in definitions
+            )
+        except (requests.RequestException, ValueError) as e:
+            self.log.error(f"Error while listing batch jobs. Error = {e}")
+            return None
+        response = self.batch_job_error_response
+        if response is not None:
+            self.log.error(
+                f"Error while listing batch jobs. Response body = {response.text}, status_code = {response.status_code}"
+            )
+            return None
+
+        self.log.info(
+            f"Batch job index built with {len(index.names)} JCL names (complete = {index.complete})"
+        )
+        index.save()
+        return index
+
+    def validate_jcl_name(self, application_id, jcl_file_name):
+        """Check that the JCL name is defined in the application.
+
+        A stale cached index is rebuilt once before the name is rejected. The
+        name is accepted when the definitions can not be listed or the index
+        had to be truncated.
+        """
+        ttl = self.fields.jcl_cache_ttl
+        index = self.get_batch_job_index(application_id, ttl)
+        if index is not None and index.cached:
+            if not index.contains(jcl_file_name):
+                index = self.get_batch_job_index(
+                    application_id, ttl, refresh=True
+                )
+
+        if index is None:
+            self.log.warning(
+                f"JCL name {jcl_file_name} is not validated, batch job definitions are not available."
+            )
+            return True
+        if index.contains(jcl_file_name) or not index.complete:
+            return True
+
+        suggestions = get_close_matches(jcl_file_name, index.names)
+        self.log.error(
+            f"JCL name {jcl_file_name} is not defined in the application {application_id}. Did you mean {suggestions}?"
+        )
+        self.rc = 1
+        self.unv_output = f"FAILED: JCL name {jcl_file_name} is not defined in the application. Similar names = {suggestions}"
+        return False
+
     def start_application(self, application_id):
         self.log.debug(f"application_id = {application_id}")
         url = self.get_aws_url(f"/applications/{application_id}/start")
@@ -435,6 +604,20 @@ class Extension(UniversalExtension):
         jcl_file_name_temp = fields.get("jcl_file_name_temp")
         if len(jcl_file_name_temp) > 0:
             jcl_file_name = jcl_file_name_temp
+        elif not jcl_file_name and self.fields.jcl_name is not None:
+            jcl_file_name = self.fields.jcl_name
+
+        validate_jcl = self.fields.validate_jcl and jcl_file_name
+        if validate_jcl and not self.validate_jcl_name(
+            application_id, jcl_file_name
+        ):
+            ui.update_output_fields(
+                {
+                    "batch_execution_id": "Failed",
+                    "application_id": application_id,
+                }
+            )
+            return application_id, "Failed"
 
         payload = {"batchJob": {"jclFileName": jcl_file_name}}
         json_payload = json.dumps(payload)
@@ -573,37 +756,49 @@ class Extension(UniversalExtension):
         if len(execution_id) > 0:
             payload["filterPattern"] = execution_id
 
-        json_payload = json.dumps(payload)
-        response = self.signed_request(
-            method="POST",
-            url=url,
-            data=json_payload,
-            headers=headers,
-            service="logs",
-        )
-        if response.status_code == 200:
-            self.log.debug(f"Response = {response.text}")
-            try:
-                self.log.info(f"Log format = {format}")
-                if format == "json":
-                    content = json.dumps(
-                        response.json(), indent=4, sort_keys=True
-                    )
-                    print(content)
-                else:
-                    for event in response.json().get("events", []):
-                        print(event.get("message"))
-            except:
-                content = response
-                self.log.error(
-                    f"Error while running batch job. Response body = {response.text}, status_code = {response.status_code}"
-                )
-                self.rc = 1
-                self.unv_output = f"FAILED: Response body = {response.text}, status_code = {response.status_code}"
-                return False
+        try:
+            include = self.compile_log_pattern(self.fields.log_include)
+            exclude = self.compile_log_pattern(self.fields.log_exclude)
+        except re.error as e:
+            self.log.error(f"Invalid log include/exclude pattern: {e}")
+            self.rc = 1
+            self.unv_output = f"FAILED: Invalid log include/exclude pattern: {e}"
+            return False
 
-            return True
+        self.log_error_response = None
+        self.log_events_truncated = False
+        if len(execution_id) > 0:
+            max_pages = LOG_EVENTS_MAX_PAGES
         else:
+            max_pages = LOG_EVENTS_UNFILTERED_PAGES
+
+        # The step tracker reads every fetched event; the filters and limits
+        # only apply to what is written to the output.
+        steps = JclStepTracker()
+        events = self.iter_log_events(url, payload, headers, max_pages)
+        events = steps.track(events)
+        events = grep_log_events(events, include=include, exclude=exclude)
+        if self.fields.log_dedupe:
+            events = dedupe_log_events(events)
+        events = limit_log_events(
+            events, head=self.fields.log_head, tail=self.fields.log_tail
+        )
+
+        self.log.info(f"Log format = {format}")
+        try:
+            if format == "json":
+                self.print_json_log_events(events, steps)
+            else:
+                for event in events:
+                    print(event.get("message"))
+        except Exception as e:
+            self.log.error(f"Error while processing the log events. Error = {e}")
+            self.rc = 1
+            self.unv_output = f"FAILED: Error while processing the log events. Error = {e}"
+            return False
+
+        response = self.log_error_response
+        if response is not None:
             self.log.error(
                 f"Error while running batch job. Response body = {response.text}, status_code = {response.status_code}"
             )
@@ -611,6 +806,330 @@ class Extension(UniversalExtension):
             self.unv_output = f"FAILED: Response body = {response.text}, status_code = {response.status_code}"
             return False
 
+        self.update_step_fields(steps)
+        return True
+
+    def iter_log_events(self, url, payload, headers, max_pages):
+        """Yield the filtered log events page by page, following nextToken.
+
+        At most ``max_pages`` pages are read; ``self.log_events_truncated``
+        tells whether more were available. A failed request stops the
+        iteration and is kept in ``self.log_error_response`` for the caller
+        to report.
+        """
+        payload = payload.copy()
+        for _ in range(max_pages):
+            json_payload = json.dumps(payload)
+            response = self.signed_request(
+                method="POST",
+                url=url,
+                data=json_payload,
+                headers=headers,
+                service="logs",
+            )
+            if response.status_code != 200:
+                self.log_error_response = response
+                return
+
+            self.log.debug(f"Response = {response.text}")
+            response_json = response.json()
+            for event in response_json.get("events", []):
+                yield event
+
+            next_token = response_json.get("nextToken")
+            if not next_token or next_token == payload.get("nextToken"):
+                return
+            payload["nextToken"] = next_token
+
+        self.log.warning(
+            f"Log events are truncated after {max_pages} page(s). Use a filter pattern to narrow them."
+        )
+        self.log_events_truncated = True
+
+    def print_json_log_events(self, events, steps):
+        """Write the events as a JSON document one event at a time."""
+        sys.stdout.write('{\n    "events": [')
+        separator = "\n"
+        for event in events:
+            content = json.dumps(event, indent=4, sort_keys=True)
+            sys.stdout.write(separator + indent_json(content, 8))
+            separator = ",\n"
+        content = json.dumps(steps.summary(), indent=4, sort_keys=True)
+        sys.stdout.write(f'\n    ],\n    "steps": {indent_json(content, 4)[4:]}\n}}\n')
+
+    def compile_log_pattern(self, pattern):
+        if pattern is None or len(pattern) == 0:
+            return None
+        return re.compile(pattern)
+
+    def update_step_fields(self, steps):
+        summary = steps.summary()
+        if len(summary) == 0:
+            return
+
+        # Failed steps are listed first so they are visible without scrolling,
+        # followed by the steps without a known outcome.
+        order = {"failed": 0, "running": 1, "unknown": 1, "ok": 2}
+        lines = []
+        if self.log_events_truncated:
+            lines.append("INCOMPLETE: the console log was truncated.")
+        for step in sorted(summary, key=lambda step: order[step["status"]]):
+            duration = step["duration"]
+            duration = "-" if duration is None else f"{duration:.1f}s"
+            if step["status"] == "running":
+                rc = "RUNNING"
+            else:
+                rc = step["rc"] or "UNKNOWN"
+            lines.append(f'{step["step"]} RC={rc} {duration}')
+        self.log.info(f"JCL steps = {summary}")
+
+        max_rc = steps.max_rc() or ""
+        if self.log_events_truncated:
+            max_rc = "INCOMPLETE"
+        out_fields = {
+            "step_summary": "\n".join(lines),
+            "max_step_rc": max_rc,
+        }
+        ui.update_output_fields(out_fields)
+
+
+class BatchJobIndex:
+    """Locally cached, sorted list of the JCL names of an application.
+
+    At most ``max_size`` names are kept; a truncated index is marked as not
+    complete so that it is not used to reject unknown names.
+    """
+
+    max_size = 50000
+    cache_dir = os.path.join(
+        tempfile.gettempdir(),
+        f"aws-m2-extension-{os.getuid()}"
+        if hasattr(os, "getuid")
+        else "aws-m2-extension",
+    )
+
+    def __init__(self, endpoint, region, application_id, ttl) -> None:
+        key = f"{endpoint}-{region}-{application_id}"
+        self.path = os.path.join(
+            self.cache_dir, re.sub(r"[^\w.-]", "_", key) + ".json"
+        )
+        self.ttl = ttl
+        self.names = []
+        self.complete = True
+        self.cached = False
+
+    def build(self, names):
+        unique_names = set()
+        self.complete = True
+        for name in names:
+            if name is None or name in unique_names:
+                continue
+            if len(unique_names) >= self.max_size:
+                self.complete = False
+                continue
+            unique_names.add(name)
+        self.names = sorted(unique_names)
+
+    def private_cache_dir(self):
+        """Create the cache directory and check that only we can access it.
+
+        Raises OSError when the directory is a symlink or belongs to another
+        user, so that a planted directory is never read or written.
+        """
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        dir_stat = os.lstat(self.cache_dir)
+        if not stat.S_ISDIR(dir_stat.st_mode):
+            raise OSError(f"{self.cache_dir} is not a directory")
+        if hasattr(os, "getuid"):
+            if dir_stat.st_uid != os.getuid():
+                raise OSError(f"{self.cache_dir} is owned by another user")
+            if dir_stat.st_mode & 0o077:
+                os.chmod(self.cache_dir, 0o700)
+        return self.cache_dir
+
+    def load(self):
+        try:
+            self.private_cache_dir()
+            if time() - os.path.getmtime(self.path) > self.ttl:
+                return False
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        self.names = cached.get("names", [])
+        self.complete = cached.get("complete", False)
+        self.cached = True
+        return True
+
+    def save(self):
+        if self.ttl <= 0:
+            return
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                dir=self.private_cache_dir(), suffix=".tmp"
+            )
+            with os.fdopen(fd, "w") as f:
+                json.dump({"names": self.names, "complete": self.complete}, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def contains(self, name):
+        position = bisect_left(self.names, name)
+        return position < len(self.names) and self.names[position] == name
+
+    def search(self, prefix, limit=500):
+        """Return up to ``limit`` names starting with ``prefix`` and the
+        total number of matching names."""
+        position = bisect_left(self.names, prefix)
+        matches = takewhile(
+            lambda name: name.startswith(prefix),
+            islice(self.names, position, None),
+        )
+        names = list(islice(matches, limit))
+        return names, len(names) + sum(1 for _ in matches)
+
+
+def batch_job_name(definition):
+    file_definition = definition.get("fileBatchJobDefinition", None)
+    if file_definition is not None:
+        return file_definition.get("fileName")
+    script_definition = definition.get("scriptBatchJobDefinition", None)
+    if script_definition is not None:
+        return script_definition.get("scriptName")
+    return None
+
+
+class JclStepTracker:
+    """Extracts JCL step boundaries and return codes from console log events.
+
+    Events are passed through unchanged; only one entry per step is kept.
+    """
+
+    def __init__(self) -> None:
+        self.steps = {}
+
+    def track(self, events):
+        for event in events:
+            self.parse(event)
+            yield event
+
+    def parse(self, event):
+        message = event.get("message") or ""
+        timestamp = event.get("timestamp")
+        for pattern in JCL_STEP_END_PATTERNS:
+            result = pattern.search(message)
+            if result:
+                step = self.steps.setdefault(
+                    result.group("step"), {"start": None}
+                )
+                rc = result.group("rc")
+                step["rc"] = None if rc is None else rc.upper()
+                step["end"] = timestamp
+                step["ended"] = True
+                return
+        for pattern in JCL_STEP_START_PATTERNS:
+            result = pattern.search(message)
+            if result:
+                self.steps[result.group("step")] = {
+                    "start": timestamp,
+                    "end": None,
+                    "rc": None,
+                    "ended": False,
+                }
+                return
+
+    def summary(self):
+        summary = []
+        for name, step in self.steps.items():
+            duration = None
+            if step["start"] is not None and step["end"] is not None:
+                duration = (step["end"] - step["start"]) / 1000
+            summary.append(
+                {
+                    "step": name,
+                    "rc": step["rc"],
+                    "duration": duration,
+                    "status": step_status(step),
+                }
+            )
+        return summary
+
+    def max_rc(self):
+        """Highest numeric RC, or the first abend code (e.g. S0C7) found."""
+        max_rc = None
+        for step in self.steps.values():
+            rc = step["rc"]
+            if rc is None:
+                continue
+            if not rc.isdigit():
+                return rc
+            if max_rc is None or int(rc) > int(max_rc):
+                max_rc = rc
+        return max_rc
+
+
+def step_status(step):
+    """One of running, unknown (ended without a RC), ok or failed."""
+    rc = step["rc"]
+    if not step["ended"]:
+        return "running"
+    if rc is None:
+        return "unknown"
+    if rc.isdigit() and int(rc) <= 4:
+        return "ok"
+    return "failed"
+
+
+def indent_json(content, width):
+    return "\n".join(" " * width + line for line in content.splitlines())
+
+
+def grep_log_events(events, include=None, exclude=None):
+    for event in events:
+        message = event.get("message") or ""
+        if include is not None and not include.search(message):
+            continue
+        if exclude is not None and exclude.search(message):
+            continue
+        yield event
+
+
+def dedupe_log_events(events):
+    """Collapses consecutive events with identical messages into the first.
+
+    Only back-to-back repeats are dropped, which keeps memory constant.
+    """
+    last_message = None
+    for event in events:
+        message = event.get("message")
+        if message == last_message:
+            continue
+        last_message = message
+        yield event
+
+
+def limit_log_events(events, head=0, tail=0):
+    """Yields the first ``head`` events, then the last ``tail`` of the rest.
+
+    A zero limit disables its window; with both at zero every event is
+    yielded. The input is always consumed to the end.
+    """
+    if head <= 0 and tail <= 0:
+        for event in events:
+            yield event
+        return
+
+    events = iter(events)
+    for event in islice(events, head):
+        yield event
+    last_events = deque(events, maxlen=tail)
+    for event in last_events:
+        yield event
+
 
 class ExtensionFields:
     def __init__(self, fields) -> None:
@@ -624,6 +1143,10 @@ class ExtensionFields:
         self.application = fields.get("application", [None])[0]
         self.jcl_file_name = fields.get("jcl_file_name", None)
         self.jcl_file_name_temp = fields.get("jcl_file_name_temp", None)
+        self.jcl_name = (fields.get("jcl_name") or [None])[0]
+        self.jcl_prefix = fields.get("jcl_prefix", "")
+        self.jcl_cache_ttl = fields.get("jcl_cache_ttl", 300) or 0
+        self.validate_jcl = fields.get("validate_jcl", True)
         self.wait = fields.get("wait", False)
         self.interval = fields.get("interval", 10)
         self.fetch_logs = fields.get("fetch_logs", False)
@@ -635,6 +1158,13 @@ class ExtensionFields:
         self.filter_pattern = fields.get("filter_pattern", "")
         self.log_stream_name = fields.get("log_stream_name", "*")
         self.log_format = fields.get("log_format", ["text"])[0]
+        # The fetch-logs action has its own set of log processing fields.
+        prefix = "fetch_log" if self.action == "fetch-logs" else "log"
+        self.log_include = fields.get(f"{prefix}_include", "")
+        self.log_exclude = fields.get(f"{prefix}_exclude", "")
+        self.log_dedupe = fields.get(f"{prefix}_dedupe", False)
+        self.log_head = fields.get(f"{prefix}_head", 0) or 0
+        self.log_tail = fields.get(f"{prefix}_tail", 0) or 0
         self.execution_id = fields.get("execution_id", None)
         self.force_stop = fields.get("force_stop", False)
 